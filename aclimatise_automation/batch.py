@@ -2,24 +2,32 @@
 Functions for analysing a batch of files
 """
 import re
+import signal
+import sys
 import time
 from datetime import datetime
 from functools import partial
 from logging.handlers import QueueHandler, QueueListener
-from multiprocessing import Manager, Pool, Queue
+from multiprocessing import Pool, Queue
 from pathlib import Path
 from typing import Collection, Optional
+from uuid import uuid4
 
 import docker
 from aclimatise import Command, WrapperGenerator, parse_help
 from docker.errors import NotFound
+from tqdm import tqdm
 
 from aclimatise_automation.tool import (
     aclimatise_exe,
     calculate_metadata,
+    clear_containers,
     commands_from_package,
     generate_wrapper,
+    init_worker,
     reanalyse_tool,
+    remove_run_containers,
+    timed_commands_from_package,
 )
 
 from .metadata import BaseCampMeta
@@ -37,21 +45,28 @@ def wrappers(
     :param command_dir: Directory to convert from
     :param output_dir: If provided, output files in the same directory structure, but in this directory
     """
-    manager = Manager()
-    queue = manager.Queue()
-    listener = QueueListener(queue, *logger.handlers)
-    listener.start()
+    queue = logging_queue()
 
-    with Pool() as pool:
-        packages = pathlib.Path(command_dir).rglob("*.yml")
+    # Resolve the root once, so that every path found beneath it is already absolute and doesn't need resolving
+    command_dir = pathlib.Path(command_dir).resolve()
+
+    with pool_context().Pool(initializer=init_logging, initargs=(queue,)) as pool:
+        packages = list(find_yml(str(command_dir)))
         func = partial(
             generate_wrapper,
             output_dir=pathlib.Path(output_dir).resolve() if output_dir else None,
-            command_dir=pathlib.Path(command_dir).resolve(),
-            logging_queue=queue,
+            command_dir=command_dir,
+        )
+        # The results are discarded, so there's no need to wait for them in order
+        exhaust(
+            tqdm(
+                pool.imap_unordered(
+                    func, packages, chunksize=chunk_size(len(packages))
+                ),
+                total=len(packages),
+                unit="file",
+            )
         )
-        pool.map(func, packages)
-    listener.stop()
 
 
 def new_definitions(
@@ -59,7 +74,7 @@ def new_definitions(
     out: Path,
     processes: int = None,
     last_meta: Path = None,
-    max_tasks: int = None,
+    max_tasks: Optional[int] = 25,
     fork: bool = True,
     wrapper_root: Path = None,
 ):
@@ -69,24 +84,22 @@ def new_definitions(
     :param out: The output directory
     :param processes: Maximum number of threads to use
     :param last_meta: The previous tool database state
-    :param max_tasks: Number of tasks before each process is regenerated
+    :param max_tasks: Number of tasks before each process is regenerated, or None to never regenerate them.
+        Regenerating workers bounds their memory usage, since the analysed Commands and Docker state otherwise
+        accumulate, but each regeneration has to reconnect to Docker and start new containers. 1 uses the least memory
+        but is slowest, while 10-50 is a good balance
     :param fork: If False, don't run in parallel (for debugging)
     """
-    manager = Manager()
-    queue = manager.Queue()
-    listener = QueueListener(queue, *logger.handlers)
-    listener.start()
-
     # Get the latest list of packages
     with metadata.open() as fp:
-        new_meta = yaml.load(fp)
+        new_meta = fast_yaml.load(fp)
     to_aclimatise = set(new_meta.packages)
 
     if last_meta:
         with last_meta.open() as fp:
-            old_meta = yaml.load(fp)
+            old_meta = fast_yaml.load(fp)
             # We don't have to aclimatise packages we've already done
-            to_aclimatise -= set(old_meta.packages)
+            to_aclimatise.difference_update(old_meta.packages)
 
     logger.info(
         "There are {} packages in the old metadata and {} in the new. There are {} to process.".format(
@@ -96,26 +109,83 @@ def new_definitions(
         )
     )
 
+    # Packages that already have an output directory would just be skipped by the workers, so don't spend API calls
+    # looking up their images
+    to_aclimatise = {
+        line
+        for line in to_aclimatise
+        if not out.joinpath(*line.strip().split("=")).exists()
+    }
+
+    # Start the packages that took longest in previous runs first, so that they don't end up holding up the end of this
+    # run. Durations are recorded by package name, since the version has usually changed since then. They're kept in
+    # the output directory so that they're committed along with the definitions, since that's the only state that
+    # survives between CI runs
+    durations_file = out / "durations.json"
+    durations = load_durations(durations_file)
+    to_aclimatise = longest_first(to_aclimatise, durations)
+
+    # Look up every package's images up front, since the API calls are much faster concurrently
+    images = prefetch_package_images(to_aclimatise)
+
+    # Containers are labelled with this, so that any that are left over at the end can be found
+    run = uuid4().hex
+
     # Iterate each package in the input file
     if fork:
-        with Pool(processes, maxtasksperchild=max_tasks) as pool:
-            logger.info("Forking into {} processes".format(pool._processes))
-            func = partial(
-                commands_from_package,
-                out=pathlib.Path(out).resolve(),
-                logging_queue=queue,
-                wrapper_root=wrapper_root,
-            )
-            pool.map(func, to_aclimatise)
+        queue = logging_queue()
+        # Turn SIGTERM into an exception like Ctrl-C, so that the leftover containers are still removed
+        previous_handler = signal.signal(signal.SIGTERM, lambda *args: sys.exit(1))
+        try:
+            with pool_context().Pool(
+                processes,
+                maxtasksperchild=max_tasks or None,
+                initializer=init_worker,
+                initargs=(queue, images, run),
+            ) as pool:
+                logger.info("Forking into {} processes".format(pool._processes))
+                func = partial(
+                    timed_commands_from_package,
+                    out=pathlib.Path(out).resolve(),
+                    wrapper_root=wrapper_root,
+                )
+                # Each package takes minutes, so the IPC overhead of unchunked tasks doesn't matter, and chunking
+                # would hand the slowest packages to the same worker
+                for package, seconds in tqdm(
+                    pool.imap_unordered(func, to_aclimatise),
+                    total=len(to_aclimatise),
+                    unit="package",
+                ):
+                    # Skipped packages would otherwise replace their real duration with the ~0s it took to skip them
+                    if seconds is not None:
+                        durations[package] = seconds
+                # Let the workers exit cleanly rather than terminating them, so they can remove their cached
+                # containers
+                pool.close()
+                pool.join()
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+            # If the pool was terminated, its workers never got to remove their containers. Failing to do so
+            # shouldn't hide the exception that got us here, if there was one
+            try:
+                remove_run_containers(run)
+            except Exception:
+                logger.warning(handle_exception())
     else:
-        for line in to_aclimatise:
-            commands_from_package(
-                line=line,
-                out=pathlib.Path(out).resolve(),
-                logging_queue=queue,
-                wrapper_root=wrapper_root,
-            )
-    listener.stop()
+        init_worker(images=images, run=run)
+        try:
+            for line in to_aclimatise:
+                package, seconds = timed_commands_from_package(
+                    line=line,
+                    out=pathlib.Path(out).resolve(),
+                    wrapper_root=wrapper_root,
+                )
+                if seconds is not None:
+                    durations[package] = seconds
+        finally:
+            clear_containers()
+
+    save_durations(durations_file, durations)
 
 
 def reanalyse(
@@ -124,7 +194,7 @@ def reanalyse(
     new_meta: Path = None,
     old_meta: Path = None,
     processes: int = None,
-    max_tasks: int = None,
+    max_tasks: Optional[int] = 25,
     fork: bool = True,
 ):
     """
@@ -135,23 +205,22 @@ def reanalyse(
     :param dir: The directory containing existing tool definitions
     :param processes: Maximum number of threads to use
     :param old_meta: The previous tool database state
-    :param max_tasks: Number of tasks before each process is regenerated
+    :param max_tasks: Number of tasks before each process is regenerated, or None to never regenerate them.
+        Regenerating workers bounds their memory usage, at the cost of forking a new process. 1 uses the least memory
+        but is slowest, while 10-50 is a good balance
     :param fork: If False, don't run in parallel (for debugging)
     """
-    manager = Manager()
-    queue = manager.Queue()
-    listener = QueueListener(queue, *logger.handlers)
-    listener.start()
-
     # Get the latest list of packages
     if new_meta is not None and old_meta is not None:
         with new_meta.open() as fp:
-            new_meta = yaml.load(fp)
+            new_meta = fast_yaml.load(fp)
 
         with old_meta.open() as fp:
-            old_meta = yaml.load(fp)
+            old_meta = fast_yaml.load(fp)
 
-        if not parse(new_meta.aclimatise_version) > parse(old_meta.aclimatise_version):
+        if not parse_version(new_meta.aclimatise_version) > parse_version(
+            old_meta.aclimatise_version
+        ):
             # If there hasn't been a new version of the parser, there's no reason to reanalyse
             logger.warning(
                 "The previous analysis was done using aclimatise=={}, while the new metadata is for an older or equal version: {}. Skipping.".format(
@@ -160,22 +229,35 @@ def reanalyse(
             )
             return
 
-    to_reanalyse = dir.rglob("*.yml")
+    to_reanalyse = list(find_yml(str(dir)))
 
     # Iterate each package in the input file
     if fork:
-        with Pool(processes, maxtasksperchild=max_tasks) as pool:
+        queue = logging_queue()
+        with pool_context().Pool(
+            processes,
+            maxtasksperchild=max_tasks or None,
+            initializer=init_logging,
+            initargs=(queue,),
+        ) as pool:
             func = partial(
                 reanalyse_tool,
                 wrapper_root=wrapper_root,
-                logging_queue=queue,
             )
-            pool.map(func, to_reanalyse)
+            exhaust(
+                tqdm(
+                    pool.imap_unordered(
+                        func,
+                        to_reanalyse,
+                        chunksize=chunk_size(len(to_reanalyse), processes),
+                    ),
+                    total=len(to_reanalyse),
+                    unit="file",
+                )
+            )
     else:
         for file in to_reanalyse:
             reanalyse_tool(
                 file,
                 wrapper_root=wrapper_root,
-                logging_queue=queue,
             )
-    listener.stop()
@@ -4,7 +4,7 @@ CLI for executing aCLImatise over Bioconda
 
 import argparse
 import sys
-from logging import ERROR, FileHandler, getLogger
+from logging import DEBUG, ERROR, INFO, WARNING, FileHandler, getLogger
 from pathlib import Path
 
 import click
@@ -15,6 +15,7 @@ from aclimatise_automation.batch import (
     reanalyse,
     wrappers,
 )
+from aclimatise_automation.util import CACHE_MODES, set_cache_mode
 from aclimatise_automation.yml import yaml
 
 # This might make conda a bit quieter
@@ -39,6 +40,13 @@ def main():
     if log_file is not None:
         logger.addHandler(FileHandler(log_file))
 
+    # Only warnings are logged by default, since logging every tool and file slows down the workers
+    logger.setLevel([WARNING, INFO, DEBUG][min(kwargs.pop("verbose"), 2)])
+
+    cache_mode = kwargs.pop("cache_mode")
+    if cache_mode is not None:
+        set_cache_mode(cache_mode)
+
     func = args.func
     kwargs.pop("func")
     func(**kwargs)
@@ -47,6 +55,20 @@ def main():
 def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--log-file", type=Path)
+    parser.add_argument(
+        "--verbose",
+        "-v",
+        action="count",
+        default=0,
+        help="Log the progress of each package. Pass twice to also log each individual tool and file",
+    )
+    parser.add_argument(
+        "--cache-mode",
+        choices=sorted(CACHE_MODES),
+        help="How API responses are cached on disk. 'enabled' reuses them for up to a day, 'replay' only uses "
+        "previously cached responses and fails on a cache miss, and 'disabled' always uses the network. Defaults to "
+        "the ACLIMATISE_CACHE_MODE environment variable if it's set, otherwise 'enabled'",
+    )
     subparsers = parser.add_subparsers()
 
     cmd_list = subparsers.add_parser(
@@ -105,8 +127,8 @@ def get_parser():
         "--max-tasks",
         "-m",
         type=int,
-        default=None,
-        help="The number of packages each process will analyse before it is replaced with a fresh worker process",
+        default=25,
+        help="The number of packages each process will analyse before it is replaced with a fresh worker process, which bounds memory usage. Lower values use less memory but are slower. Use 0 to never replace workers",
     )
     cmd_install.add_argument(
         "metadata",
@@ -162,8 +184,8 @@ def get_parser():
         "--max-tasks",
         "-m",
         type=int,
-        default=None,
-        help="The number of packages each process will analyse before it is replaced with a fresh worker process",
+        default=25,
+        help="The number of packages each process will analyse before it is replaced with a fresh worker process, which bounds memory usage. Lower values use less memory but are slower. Use 0 to never replace workers",
     )
     cmd_reanalyse.set_defaults(func=reanalyse)
 
@@ -2,47 +2,354 @@
 Functions for analysing single tools (which are called by functions in batch.py)
 """
 import re
+import shutil
+import signal
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import partial
 from logging.handlers import QueueHandler, QueueListener
 from multiprocessing import Manager, Pool, Queue
+from multiprocessing.util import Finalize
 from pathlib import Path
-from typing import Collection, Optional
+from typing import Collection, Dict, List, Optional, Tuple, Union
 
 import docker
 from aclimatise import Command, WrapperGenerator, parse_help
-from docker.errors import NotFound
+from docker.errors import APIError, NotFound
 
 from .metadata import BaseCampMeta
 from .util import *
 
 logger = getLogger()
 
+# Matches the URL scheme that some image names are prefixed with, which Docker doesn't accept
+scheme = re.compile("^https?://")
 
-def reanalyse_tool(tool: Path, logging_queue: Queue, wrapper_root: Path = None):
+# The Docker client for this process. It's created lazily, and then shared by every task that this worker runs
+_client: Optional[docker.DockerClient] = None
+
+# Containers this process has started, keyed by image, so that packages sharing an image can reuse them. The least
+# recently used container is removed once there are more than CONTAINER_CACHE_SIZE
+_containers: "OrderedDict[str, Container]" = OrderedDict()
+CONTAINER_CACHE_SIZE = 4
+
+# IDs of images that no running container is using, oldest first. They are kept on disk until there are more than
+# IMAGE_CACHE_SIZE, so that a later package using the same image doesn't have to pull it again
+_idle_images: "OrderedDict[str, None]" = OrderedDict()
+IMAGE_CACHE_SIZE = 4
+
+# Containers and images are removed on this thread, so that the worker can move on to its next package while the
+# daemon cleans up. There's only one thread, so that each container is removed before its image
+_cleanup: Optional[ThreadPoolExecutor] = None
+
+# Images for each package that were looked up in bulk before the pool was started
+_package_images: Dict[str, Optional[List[dict]]] = {}
+
+# Every container is labelled with the ID of the run that started it, so that the main process can remove any that
+# a worker didn't get to clean up itself, for example because the pool was terminated
+RUN_LABEL = "aclimatise-automation.run"
+_run: Optional[str] = None
+
+
+def get_client() -> docker.DockerClient:
+    """
+    Returns the Docker client for this process, connecting to the daemon the first time it's called
+    """
+    global _client, _cleanup
+    if _client is None:
+        _client = docker.from_env()
+        _cleanup = ThreadPoolExecutor(max_workers=1)
+        # Containers outlive the tasks that start them, so they have to be cleaned up when the process exits
+        Finalize(None, clear_containers, exitpriority=10)
+    return _client
+
+
+def image_available(client: docker.DockerClient, image: str) -> bool:
+    """
+    Checks if an image can be pulled, by asking the registry for its manifest instead of actually pulling it
+    """
+    try:
+        client.images.get_registry_data(image)
+        return True
+    except APIError:
+        return False
+
+
+def image_id(container: Container) -> str:
+    """
+    Returns the ID of the image a container was started from, without asking the daemon for the whole image
+    """
+    return container.attrs["Image"]
+
+
+def in_background(func, *args, **kwargs):
+    """
+    Runs a cleanup function on the cleanup thread, logging rather than raising any errors. If the cleanup thread has
+    been shut down, the function is run immediately instead
+    """
+
+    def run():
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.warning(handle_exception())
+
+    try:
+        _cleanup.submit(run)
+    except (AttributeError, RuntimeError):
+        run()
+
+
+def image_in_use(image: str) -> bool:
+    """
+    Checks if any of the containers this process is keeping alive were started from the given image
+    """
+    return any(image_id(container) == image for container in _containers.values())
+
+
+def release_image(client: docker.DockerClient, image_id: str):
+    """
+    Marks an image as no longer needed by a container, removing the least recently released images that are no longer
+    in use once there are more than IMAGE_CACHE_SIZE of them
+    """
+    _idle_images[image_id] = None
+    _idle_images.move_to_end(image_id)
+    while len(_idle_images) > IMAGE_CACHE_SIZE:
+        victim, _ = _idle_images.popitem(last=False)
+        if not image_in_use(victim):
+            in_background(client.images.remove, victim, force=True)
+
+
+def remove_container(container: Container):
+    """
+    Kills and removes a container in the background, and releases its image
+    """
+    # Forcing the removal also kills the container, so this is a single call to the daemon
+    in_background(container.remove, force=True)
+    release_image(container.client, image_id(container))
+
+
+def clear_containers():
+    """
+    Removes all the containers this process is keeping alive, and all of their images
+    """
+    while len(_containers) > 0:
+        _, container = _containers.popitem()
+        try:
+            remove_container(container)
+        except Exception:
+            logger.warning(handle_exception())
+
+    while len(_idle_images) > 0:
+        image, _ = _idle_images.popitem()
+        in_background(get_client().images.remove, image, force=True)
+
+    # Wait for everything to actually be removed
+    if _cleanup is not None:
+        _cleanup.shutdown(wait=True)
+
+
+def cached_container(images: List[str]) -> Optional[Container]:
+    """
+    Returns a container this process has already started from one of the given images, if there is one
+    """
+    for image in images:
+        if image not in _containers:
+            continue
+        container = _containers[image]
+        # The container may have died, or been removed by someone else, since the last package used it
+        try:
+            container.reload()
+            running = container.status == "running"
+        except Exception:
+            running = False
+        if not running:
+            evict_container(container)
+            continue
+        _containers.move_to_end(image)
+        return container
+    return None
+
+
+def evict_container(container: Container):
+    """
+    Stops keeping a container alive for reuse, and removes it
+    """
+    for image, cached in list(_containers.items()):
+        if cached is container:
+            del _containers[image]
+    try:
+        remove_container(container)
+    except Exception:
+        logger.warning(handle_exception())
+
+
+def cache_container(image: str, container: Container):
+    """
+    Keeps a container alive for reuse by later packages, removing the least recently used one if the cache is full
+    """
+    _containers[image] = container
+    _idle_images.pop(image_id(container), None)
+    while len(_containers) > CONTAINER_CACHE_SIZE:
+        _, victim = _containers.popitem(last=False)
+        remove_container(victim)
+
+
+def wait_for_start(container: Container, timeout: int) -> bool:
+    """
+    Waits for a container to leave the "created" state, by listening for its start event rather than polling
+    :param timeout: Number of seconds to wait
+    :return: False if the container still hadn't started after the timeout
+    """
+    container.reload()
+    if container.status not in {"created", "restarting"}:
+        return True
+
+    # The event stream replays anything since the given time, so the start event can't be missed even if it happened
+    # before we subscribed, and it closes itself once the timeout has passed
+    now = int(time.time())
+    events = container.client.events(
+        since=now - timeout,
+        until=now + timeout,
+        filters={"container": container.id, "event": "start"},
+        decode=True,
+    )
+    try:
+        for _ in events:
+            break
+    finally:
+        events.close()
+
+    container.reload()
+    return container.status not in {"created", "restarting"}
+
+
+def start_container(
+    client: docker.DockerClient, images: List[str], logger=logger
+) -> Optional[Container]:
+    """
+    Starts a long-running container from the first of the given images that can be pulled, and caches it
+    :return: The running container, or None if none of the images could be started
+    """
+    # Probe the registries concurrently, so that stale images don't each cost us a failed pull
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        available = list(executor.map(partial(image_available, client), images))
+
+    for formatted_image, is_available in zip(images, available):
+        if not is_available:
+            logger.warning(
+                "{} is not in its registry, trying next image.".format(formatted_image)
+            )
+            continue
+        try:
+            container = client.containers.run(
+                image=formatted_image,
+                entrypoint=["sleep", "999999999"],
+                detach=True,
+                labels={RUN_LABEL: _run or ""},
+            )
+            logger.info("Successfully started")
+            break
+        except NotFound:
+            logger.warning(
+                "Failed to pull from {}, trying next image.".format(formatted_image)
+            )
+    else:
+        logger.error("No images could be pulled")
+        return None
+
+    try:
+        if not wait_for_start(container, timeout=60):
+            logger.error("Stopped waiting for container to start after 60 seconds")
+            remove_container(container)
+            return None
+
+        # Anything other than "running" is bad
+        if container.status != "running":
+            logger.error(
+                "Container {} is not running. It has status {}. Logs show: {}".format(
+                    container.id,
+                    container.status,
+                    container.logs(stderr=True, stdout=True),
+                )
+            )
+            remove_container(container)
+            return None
+    except Exception:
+        remove_container(container)
+        raise
+
+    cache_container(formatted_image, container)
+    return container
+
+
+def init_worker(
+    logging_queue: Optional[Queue] = None,
+    images: Optional[Dict[str, Optional[List[dict]]]] = None,
+    run: Optional[str] = None,
+):
+    """
+    Pool initializer that connects each worker process to the Docker daemon once, rather than once per package
+    :param logging_queue: The queue to send log records through, as returned by logging_queue. If not provided, this
+        process logs directly
+    :param images: Prefetched images for each package, as returned by prefetch_package_images
+    :param run: An ID for this run, which every container this process starts is labelled with
+    """
+    global _package_images, _run
+    if logging_queue is not None:
+        init_logging(logging_queue)
+    # The main process turns SIGTERM into an exception so it can clean up, but workers should still just exit when the
+    # pool is terminated
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if images is not None:
+        _package_images = images
+    _run = run
+    get_client()
+
+
+def remove_run_containers(run: str):
+    """
+    Removes every container that was started during the given run, along with its image. This is called by the main
+    process after the pool has finished, since workers that are terminated can't remove their own containers
+    """
+    client = docker.from_env()
+    containers = client.containers.list(
+        all=True, filters={"label": "{}={}".format(RUN_LABEL, run)}
+    )
+    for container in containers:
+        logger.warning("Removing leftover container {}".format(container.id))
+        try:
+            container.remove(force=True)
+            # Listed containers have the image ID under a different key than inspected ones
+            client.images.remove(container.attrs["ImageID"], force=True)
+        except APIError:
+            logger.warning(handle_exception())
+
+
+def reanalyse_tool(tool: Union[str, Path], wrapper_root: Path = None):
     """
     Reanalyses a file, replacing its contents with a new parse
     :param tool: Path to the file to reanalyse
     :param wrapper_root: If provided, also generate wrappers from the re-analysed tools,
         dump the output into the same folder hierarchy within this directory
     """
+    tool = Path(tool)
+
     # Setup a logger for this task
-    logger = getLogger(str(tool))
-    logger.handlers = []
-    logger.addHandler(QueueHandler(logging_queue))
+    logger = task_logger(str(tool))
 
     logger.info("Reanalysing...".format(tool))
     with tool.open() as fp:
-        old_cmd: Command = yaml.load(fp)
+        old_cmd: Command = fast_yaml.load(fp)
 
     if old_cmd.help_text is None or len(old_cmd.help_text) == 0:
         logger.warning("Has no help text to re-analyse")
         return
 
-    gen = YmlGenerator()
     new_cmd = old_cmd.reanalyse()
-    gen.save_to_file(new_cmd, tool)
+    yml_generator.save_to_file(new_cmd, tool)
 
     if wrapper_root:
         wrapper_from_command(
@@ -55,15 +362,14 @@ def reanalyse_tool(tool: Path, logging_queue: Queue, wrapper_root: Path = None):
 
 
 def commands_from_package(
-    line: str, out: pathlib.Path, logging_queue: Queue, wrapper_root: Path = None
-):
+    line: str, out: pathlib.Path, wrapper_root: Path = None
+) -> bool:
     """
     Given a package name, install it in an isolated environment, and aclimatise all package binaries
+    :return: False if the package was skipped without being processed, for example because it was already done
     """
     versioned_package = line.strip()
-    logger = getLogger(versioned_package)
-    logger.handlers = []
-    logger.addHandler(QueueHandler(logging_queue))
+    logger = task_logger(versioned_package)
 
     package, version = versioned_package.split("=")
 
@@ -73,67 +379,34 @@ def commands_from_package(
         out_subdir.mkdir(parents=True, exist_ok=False)
     except FileExistsError:
         logger.warning("Directory already exists for {}={}".format(package, version))
-        return
+        return False
 
-    resp = requests.get(
-        f"https://api.biocontainers.pro/ga4gh/trs/v2/tools/{package}/versions/{package}-{version}"
-    ).json()
-    package_images = sorted(
-        [
-            img
-            for img in resp["images"]
-            if ("image_type" in img and img["image_type"] == "Docker")
-        ],
-        key=lambda image: (
-            # Sort firstly by updated date, and then secondly prioritise quay.io images (since they are the automated
-            # bioconda builds)
-            datetime.fromisoformat(image["updated"].rstrip("Z")),
-            image.get("registry_host").startswith("quay.io"),
-        ),
-        reverse=True,
-    )
+    images = _package_images.get(versioned_package)
+    if images is None:
+        try:
+            images = package_images(versioned_package)
+        except Exception:
+            logger.error(
+                "Failed to look up images for {}: {}".format(
+                    versioned_package, handle_exception()
+                )
+            )
+            # Nothing has been written yet, so let a later run try this package again
+            out_subdir.rmdir()
+            return False
+
+    formatted_images = [scheme.sub("", image["image_name"]) for image in images]
 
     container = None
     try:
         logger.info("aCLImatising {}".format(versioned_package))
-        client = docker.from_env()
-        for image in package_images:
-            formatted_image = re.sub("https?://", "", image["image_name"])
-            try:
-                container = client.containers.run(
-                    image=formatted_image,
-                    entrypoint=["sleep", "999999999"],
-                    detach=True,
-                )
-                logger.info("Successfully started")
-                break
-            except NotFound:
-                logger.warning(
-                    "Failed to pull from {}, trying next image.".format(formatted_image)
-                )
+        container = cached_container(formatted_images)
+        if container is not None:
+            logger.info("Reusing a running container")
         else:
-            logger.error("No images could be pulled")
-            return
-
-        # Wait for container to start
-        start = time.time()
-        while container.status == "starting":
-            time.sleep(1)
-
-            if time.time() >= start + 60:
-                logger.error("Stopped waiting for container to start after 60 seconds")
-                return
-
-        # Anything other than "running" is bad
-        if not container.status != "running":
-            logger.error(
-                "Container {} is not running. It has status {}. Logs show: {}".format(
-                    container.id,
-                    container.status,
-                    container.logs(stderr=True, stdout=True),
-                )
-            )
-            return
+            container = start_container(get_client(), formatted_images, logger)
+            if container is None:
+                return True
 
         logger.info("Finding binaries")
         new_exes = get_package_binaries(container, package, version)
@@ -142,48 +415,65 @@ def commands_from_package(
         # Aclimatise each new executable
         if len(new_exes) == 0:
             logger.error(
-                "Package {} has no executables. Skipping.".format(formatted_image)
+                "Package {} has no executables. Skipping.".format(versioned_package)
             )
+            return True
+
+        # Run all the top level help commands in one go, rather than one exec_run each
+        executor = BatchDockerExecutor(container, new_exes, timeout=10)
         for exe in new_exes:
             aclimatise_exe(
-                container, exe, out_dir=out_subdir, wrapper_root=wrapper_root
+                container,
+                exe,
+                out_dir=out_subdir,
+                wrapper_root=wrapper_root,
+                executor=executor,
             )
 
     except Exception as e:
         logger.warning(
-            "Exception in process currently processing {}: {}. Cleaning up.".format(
+            "Exception in process currently processing {}: {}.".format(
                 versioned_package, handle_exception()
             )
         )
-
-    finally:
+        # The container may be in a bad state, so don't let later packages reuse it
         if container is not None:
-            # Clean up
-            container.kill()
-            container.remove(force=True)
-            container.client.images.remove(container.image.id, force=True)
+            evict_container(container)
+        # Remove any partial output, so that a later run tries this package again
+        shutil.rmtree(out_subdir, ignore_errors=True)
+
+    return True
+
+
+def timed_commands_from_package(line: str, **kwargs) -> Tuple[str, Optional[float]]:
+    """
+    Runs commands_from_package, measures how long it takes, and then frees the memory it used
+    :return: A tuple of the package name, and the number of seconds it took, or None if it was skipped
+    """
+    start = time.time()
+    processed = commands_from_package(line, **kwargs)
+    duration = time.time() - start
+    release_memory()
+    return package_name(line), duration if processed else None
 
 
 def generate_wrapper(
-    command: pathlib.Path,
+    command: Union[str, pathlib.Path],
     command_dir: pathlib.Path,
-    logging_queue: Queue,
     output_dir: Optional[os.PathLike] = None,
 ):
     """
     Recursively convert all .yml dumped Commands into tool wrappers
     :param command_dir: Root directory to convert from
-    :param command: Path to a YAML file to convert
+    :param command: Path to a YAML file to convert. This should be within command_dir, and absolute if command_dir is
     :param output_dir: If provided, output files in the same directory structure, but in this directory
     """
-    logger = getLogger(str(command))
-    logger.handlers = []
-    logger.addHandler(QueueHandler(logging_queue))
+    logger = task_logger(str(command))
 
-    command = command.resolve()
+    command = pathlib.Path(command)
 
     with command.open() as fp:
-        cmd: Command = yaml.load(fp)
+        cmd: Command = fast_yaml.load(fp)
 
     wrapper_from_command(
         cmd=cmd,
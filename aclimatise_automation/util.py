@@ -1,49 +1,168 @@
 """
 Utilities for executing aCLImatise over Bioconda
 """
+import atexit
+import ctypes
+import gc
 import io
 import json
 import os
 import pathlib
+import shlex
 import sys
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager, redirect_stderr, redirect_stdout
+from datetime import datetime
+from functools import lru_cache
 from itertools import chain
-from logging import getLogger
-from multiprocessing import Lock
-from typing import Collection, List
+from logging import Logger, getLogger
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import Lock, Queue, get_context
+from queue import Empty
+from typing import Collection, Dict, Iterator, List, Optional, Set, Tuple
 
+import orjson
 import requests
 from aclimatise import Command, WrapperGenerator, explore_command
 from aclimatise.converter.yml import YmlGenerator
 from aclimatise.execution.docker import DockerExecutor
 from docker.models.containers import Container
 from packaging.version import parse
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
+from urllib3.util.retry import Retry
 
 from aclimatise_automation.metadata import BaseCampMeta
-from aclimatise_automation.yml import yaml
+from aclimatise_automation.yml import fast_yaml, yaml
 
 logger = getLogger(__name__)
 
+# Worker processes send their log records through this queue, so that the main process can handle them. It's created
+# once per process lifetime by logging_queue(), and handed to each worker by init_logging()
+_logging_queue: Optional[Queue] = None
 
+# The queue that this process should send its log records through, if it's a worker. Tasks that run in the main process
+# log directly, since sending their records through the queue would just pickle them for no reason
+_worker_queue: Optional[Queue] = None
+
+# Directories that this process has already created, or found to exist
+_created_dirs: Set[pathlib.Path] = set()
+
+# One instance of each WrapperGenerator, created the first time wrapper_generators() is called in this process
+_generators: Optional[List[WrapperGenerator]] = None
+
+# The generator for the YAML Command dumps. It has no state, so it's shared by every task
+yml_generator = YmlGenerator()
+
+# Parsing versions is fairly slow, and many packages share the same version strings
+parse_version = lru_cache(maxsize=4096)(parse)
+
+# How API responses are cached on disk. "enabled" caches them for a while, "replay" only ever uses cached responses and
+# fails on a cache miss (for reproducing a previous run), and "disabled" always uses the network
+CACHE_MODES = {"enabled", "replay", "disabled"}
+
+# The cache mode that get_session() will use. It can be set with the ACLIMATISE_CACHE_MODE environment variable, or
+# with set_cache_mode() before the first API call
+_cache_mode = os.environ.get("ACLIMATISE_CACHE_MODE", "enabled")
+
+# The session for API calls, which is only created the first time one is made, so that commands that don't call the
+# API don't open the cache
+_session: Optional[requests.Session] = None
+
+
+def make_session(cache_mode: str = "enabled") -> requests.Session:
+    """
+    Creates a session for API calls, which reuses its connections instead of re-handshaking each time. Transient
+    server errors and rate limiting are retried with a backoff, rather than failing the whole package
+    :param cache_mode: One of CACHE_MODES
+    """
+    if cache_mode not in CACHE_MODES:
+        raise ValueError(
+            "Cache mode must be one of {}, not {}".format(CACHE_MODES, cache_mode)
+        )
+
+    if cache_mode == "disabled":
+        session = requests.Session()
+    else:
+        session = CachedSession(
+            "aclimatise_automation",
+            backend="sqlite",
+            use_cache_dir=True,
+            # The tool catalogue and PyPI change often, but the images for a specific package version rarely do
+            expire_after=3600,
+            urls_expire_after={
+                "api.biocontainers.pro/ga4gh/trs/v2/tools/*/versions/*": 86400,
+            },
+            only_if_cached=cache_mode == "replay",
+        )
+        # SQLite connections can't be shared with forked workers, so they have to open their own
+        os.register_at_fork(after_in_child=session.cache.close)
+
+        if cache_mode == "replay":
+            # A cache miss is returned as a 504, which would otherwise be mistaken for a real response
+            session.hooks["response"].append(
+                lambda response, *args, **kwargs: response.raise_for_status()
+            )
+
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+            ),
+        ),
+    )
+    return session
+
+
+def set_cache_mode(cache_mode: str):
+    """
+    Chooses how API responses are cached. This has no effect once an API call has been made
+    :param cache_mode: One of CACHE_MODES
+    """
+    global _cache_mode
+    _cache_mode = cache_mode
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the session for API calls, creating it the first time it's called
+    """
+    global _session
+    if _session is None:
+        _session = make_session(_cache_mode)
+    return _session
+
+
+@lru_cache(maxsize=None)
 def latest_package_version(package: str) -> str:
     """
     Gets the latest version number of a PyPI package
     """
-    req = requests.get("https://pypi.python.org/pypi/{}/json".format(package))
-    return req.json()["info"]["version"]
+    req = get_session().get("https://pypi.python.org/pypi/{}/json".format(package))
+    return orjson.loads(req.content)["info"]["version"]
+
+
+# Package name prefixes for R and Bioconductor packages, which rarely have a command line interface
+R_PREFIXES = ("r-", "bioconductor-")
 
 
 def latest_biocontainers(filter_r: bool, filter_type: List[str]) -> List[str]:
+    filter_type = set(filter_type)
     images = set()
-    for package in requests.get(
+    response = get_session().get(
         "https://api.biocontainers.pro/ga4gh/trs/v2/tools",
         params=dict(toolClass="Docker", limit=10000),
-    ).json():
-        if filter_r and (
-            package["name"].startswith("r-")
-            or package["name"].startswith("bioconductor-")
-        ):
+    )
+    # The response is several MB, which orjson parses much faster than the standard library
+    for package in orjson.loads(response.content):
+        name = package["name"]
+        if filter_r and name.startswith(R_PREFIXES):
             continue
 
         # Only consider tools of the chosen type
@@ -51,12 +170,172 @@ def latest_biocontainers(filter_r: bool, filter_type: List[str]) -> List[str]:
             continue
 
         latest_version = max(
-            package["versions"], key=lambda v: parse(v["meta_version"])
+            (version["meta_version"] for version in package["versions"]),
+            key=parse_version,
         )
-        images.add("{}={}".format(package["name"], latest_version["meta_version"]))
+        images.add("{}={}".format(name, latest_version))
     return list(images)
 
 
+def package_name(versioned_package: str) -> str:
+    """
+    Returns just the name of a package in the form "package=version"
+    """
+    return versioned_package.strip().split("=")[0]
+
+
+def load_durations(path: pathlib.Path) -> Dict[str, float]:
+    """
+    Loads the number of seconds each package took to process in previous runs, or an empty dictionary if this is the
+    first run
+    """
+    if not path.exists():
+        return {}
+    with path.open() as fp:
+        return json.load(fp)
+
+
+def save_durations(path: pathlib.Path, durations: Dict[str, float]):
+    """
+    Saves the number of seconds each package took to process, for scheduling future runs
+    """
+    with path.open("w") as fp:
+        json.dump(durations, fp, indent=2, sort_keys=True)
+
+
+def longest_first(packages: Collection[str], durations: Dict[str, float]) -> List[str]:
+    """
+    Orders packages so that the ones that took longest in previous runs come first. Packages without a recorded
+    duration come last, with the longest package strings first
+    :param packages: Packages in the form "package=version"
+    :param durations: Seconds each package took in previous runs, keyed by package name, as returned by load_durations
+    """
+    return sorted(
+        packages,
+        key=lambda line: (durations.get(package_name(line), 0), len(line)),
+        reverse=True,
+    )
+
+
+def image_priority(image: dict) -> Tuple[datetime, bool]:
+    """
+    Returns a sort key for an image from the biocontainers API, where more preferable images have larger keys
+    """
+    # Sort firstly by updated date, and then secondly prioritise quay.io images (since they are the automated bioconda
+    # builds)
+    return (
+        datetime.fromisoformat(image["updated"].rstrip("Z")),
+        image.get("registry_host").startswith("quay.io"),
+    )
+
+
+def package_images(versioned_package: str) -> List[dict]:
+    """
+    Lists the Docker images for a package, with the most preferable images first
+    :param versioned_package: A package and version, in the form "package=version"
+    """
+    package, version = versioned_package.split("=")
+    response = get_session().get(
+        f"https://api.biocontainers.pro/ga4gh/trs/v2/tools/{package}/versions/{package}-{version}"
+    )
+    resp = orjson.loads(response.content)
+    return sorted(
+        [img for img in resp["images"] if img.get("image_type") == "Docker"],
+        key=image_priority,
+        reverse=True,
+    )
+
+
+def prefetch_package_images(
+    packages: Collection[str], threads: int = 32
+) -> Dict[str, Optional[List[dict]]]:
+    """
+    Looks up the images for many packages concurrently, so that the API latency overlaps
+    :param packages: Packages in the form "package=version"
+    :param threads: Maximum number of concurrent requests
+    :return: A dictionary mapping each package to its images, or to None if the lookup failed
+    """
+
+    def fetch(versioned_package: str) -> Optional[List[dict]]:
+        try:
+            return package_images(versioned_package)
+        except Exception:
+            logger.warning(
+                "Failed to fetch images for {}: {}".format(
+                    versioned_package, handle_exception()
+                )
+            )
+            return None
+
+    packages = list(packages)
+    # Create the session before the threads need it, so that they don't each create their own
+    get_session()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return dict(zip(packages, executor.map(fetch, packages)))
+
+
+class BatchedQueueListener(QueueListener):
+    """
+    A QueueListener that takes all the records that are waiting in the queue at once, and flushes each handler after
+    the whole batch. Records are still passed to the handlers using handle(), so that their filters, locking and error
+    handling all work as usual
+    """
+
+    #: The maximum number of records to handle at once
+    batch_size = 256
+
+    def _monitor(self):
+        while True:
+            batch = [self.dequeue(True)]
+            while len(batch) < self.batch_size and batch[-1] is not self._sentinel:
+                try:
+                    batch.append(self.dequeue(False))
+                except Empty:
+                    break
+
+            for record in batch:
+                if record is not self._sentinel:
+                    self.handle(record)
+            for handler in self.handlers:
+                handler.flush()
+
+            if batch[-1] is self._sentinel:
+                return
+
+
+def logging_queue() -> Queue:
+    """
+    Returns the queue that workers should send their log records through. The first time this is called, it also starts
+    a listener that passes the records on to the root logger's handlers
+    """
+    global _logging_queue
+    if _logging_queue is None:
+        _logging_queue = Queue()
+        listener = BatchedQueueListener(_logging_queue, *getLogger().handlers)
+        listener.start()
+        atexit.register(listener.stop)
+    return _logging_queue
+
+
+def init_logging(queue: Queue):
+    """
+    Pool initializer that makes this worker send its log records through the given queue
+    """
+    global _worker_queue
+    _worker_queue = queue
+
+
+def task_logger(name: str) -> Logger:
+    """
+    Returns a logger for a single task, which sends its records to the main process if we are in a worker
+    """
+    logger = getLogger(name)
+    logger.handlers = []
+    if _worker_queue is not None:
+        logger.addHandler(QueueHandler(_worker_queue))
+    return logger
+
+
 def ctx_print(msg, verbose=True):
     if verbose:
         print(msg, file=sys.stderr)
@@ -68,7 +347,8 @@ def get_conda_binaries(verbose):
         raise Exception("You must be in a conda environment to run this")
 
     ctx_print("Conda env is {}".format(conda_env), verbose)
-    return set((pathlib.Path(conda_env) / "bin").iterdir())
+    with os.scandir(os.path.join(conda_env, "bin")) as entries:
+        return {entry.path for entry in entries}
 
 
 def get_package_binaries(container: Container, package: str, version: str) -> List[str]:
@@ -76,8 +356,10 @@ def get_package_binaries(container: Container, package: str, version: str) -> Li
     Given an already installed package, lists the binaries provided by it
     """
     logger = getLogger(package)
+
+    # A login shell would source the whole conda profile first, which is slow and isn't needed to expand a glob
     code, output = container.exec_run(
-        "bash -l -c 'cat /usr/local/conda-meta/{}*.json'".format(package),
+        ["sh", "-c", "cat /usr/local/conda-meta/{}*.json".format(package)],
         demux=True,
         stderr=True,
     )
@@ -85,7 +367,7 @@ def get_package_binaries(container: Container, package: str, version: str) -> Li
 
     # The binaries in a given package are listed in the files key of the metadata file
     try:
-        parsed = json.loads(stdout)
+        parsed = orjson.loads(stdout)
     except:
         # If the metadata fails to parse, we have to assume there are no binaries
         logger.warning(
@@ -93,15 +375,10 @@ def get_package_binaries(container: Container, package: str, version: str) -> Li
         )
         return []
 
-    paths = [pathlib.Path(f) for f in parsed["files"]]
-
     # Only return binaries, not just any package file. Their actual location is relative to the prefix
-    # Filter out files that are within subdirectories inside /bin
-    return [
-        pathlib.Path(f).name
-        for f in paths
-        if f.parent.name == "bin" and len(f.parts) == 2
-    ]
+    # Filter out files that are within subdirectories inside /bin. This compares strings rather than creating a Path for
+    # every file, since some packages have thousands
+    return [f[4:] for f in parsed["files"] if f.startswith("bin/") and "/" not in f[4:]]
 
 
 def list_bin(ctx):
@@ -121,30 +398,172 @@ def exhaust(gen):
         pass
 
 
+def find_yml(root: str) -> Iterator[str]:
+    """
+    Recursively finds all the .yml files under a directory. This uses os.scandir rather than Path.rglob, since it
+    avoids creating a Path for every entry and reuses the file type information from the directory listing. Like
+    rglob, it doesn't descend into symlinked directories, but does return symlinked files
+    :param root: The directory to search
+    :return: An iterator of paths, as strings
+    """
+    stack = [root]
+    while len(stack) > 0:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".yml"):
+                    yield entry.path
+
+
+def chunk_size(tasks: int, processes: int = None) -> int:
+    """
+    Picks a chunksize for Pool.imap_unordered that gives each process around 4 chunks of work
+    :param tasks: The total number of tasks
+    :param processes: The number of processes in the pool, or None if it's using all the CPUs
+    """
+    return max(1, tasks // ((processes or os.cpu_count()) * 4))
+
+
+def pool_context():
+    """
+    Returns the multiprocessing context that pools should use. On Linux this is always "fork", so that workers
+    (including replacement workers when maxtasksperchild is set) don't have to re-import every module
+    """
+    if sys.platform == "linux":
+        return get_context("fork")
+    return get_context()
+
+
+def release_memory():
+    """
+    Runs the garbage collector, and then asks glibc to return the memory it freed to the OS, if we are using glibc
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
 def flush():
     sys.stdout.flush()
     sys.stderr.flush()
 
 
+class BatchDockerExecutor(DockerExecutor):
+    """
+    A DockerExecutor that runs the help commands for many executables using a single exec_run, instead of one exec_run
+    per command. Any other commands, such as those for subcommands, are still run individually, as is anything whose
+    output couldn't be recovered from the batch
+    """
+
+    def __init__(
+        self,
+        container: Container,
+        exes: List[str],
+        deadline: int = 300,
+        max_output: int = 1024 * 1024,
+        **kwargs,
+    ):
+        """
+        :param container: The running container to execute inside
+        :param exes: The executables whose help commands should be run up front
+        :param deadline: Number of seconds after which the whole batch is stopped. Commands that didn't finish in time
+            are run individually instead
+        :param max_output: Maximum number of bytes kept from each command's stdout and stderr
+        """
+        super().__init__(container, **kwargs)
+        self.deadline = deadline
+        self.max_output = max_output
+        try:
+            self.outputs = self.execute_many(
+                [[exe] + flag for exe in exes for flag in self.flags]
+            )
+        except Exception:
+            # Each command will just be run individually instead
+            logger.warning(handle_exception())
+            self.outputs = {}
+
+    def execute_many(self, commands: List[List[str]]) -> Dict[Tuple[str, ...], str]:
+        """
+        Runs many commands in one shell script, and returns the output of each one that could be recovered
+        """
+        if len(commands) == 0:
+            return {}
+
+        err = "/tmp/aclimatise_stderr"
+        # Each command's output is a record consisting of its index, stdout and stderr, separated by the ASCII unit
+        # separator, and the records are separated by the record separator. We rely on the timeout utility to replace
+        # the executor's own timeout, so give up if it doesn't work. Unlike the executor's timeout, which also gives up
+        # on a command that stops producing output, this only limits how long each command can run for
+        script = ["timeout 1 true && : > {} || exit 1".format(err)]
+        for i, command in enumerate(commands):
+            script.append(
+                "printf '\\036%d\\037' {}; timeout {} {} < /dev/null 2> {} | head -c {}; printf '\\037'; head -c {} {}".format(
+                    i,
+                    int(self.timeout),
+                    " ".join(map(shlex.quote, command)),
+                    err,
+                    self.max_output,
+                    self.max_output,
+                    err,
+                )
+            )
+        code, output = self.container.exec_run(
+            ["timeout", str(self.deadline), "sh", "-c", "\n".join(script)]
+        )
+
+        records = output.split(b"\x1e")[1:]
+        if code == 124:
+            # The batch hit its deadline, so the last record may have been cut off
+            records = records[:-1]
+        elif code != 0:
+            return {}
+
+        outputs = {}
+        for record in records:
+            fields = record.split(b"\x1f")
+            if len(fields) != 3:
+                # The output contained a separator, so we can't tell where it ends
+                continue
+            index, stdout, stderr = fields
+            try:
+                outputs[tuple(commands[int(index)])] = (stdout or stderr).decode()
+            except (ValueError, IndexError):
+                # The output contained a separator, and the index was actually part of the output. This includes
+                # UnicodeDecodeError, which individual execution handles instead
+                continue
+        return outputs
+
+    def execute(self, command: List[str]) -> str:
+        output = self.outputs.get(tuple(command))
+        if output is not None:
+            return output
+        return super().execute(command)
+
+
 def aclimatise_exe(
     container: Container,
     exe: str,
     out_dir: pathlib.Path,
     wrapper_root: pathlib.Path = None,
+    executor: Optional[DockerExecutor] = None,
 ):
     """
     Given an executable path, aclimatises it, and dumps the results in out_dir
+    :param executor: The executor to run the commands with. If not provided, a DockerExecutor is created for this
+        executable
     """
-    gen = YmlGenerator()
-    logger.info("Exploring {}".format(exe))
+    logger.debug("Exploring {}".format(exe))
 
     try:
-        exec = DockerExecutor(container, timeout=10)
+        exec = executor or DockerExecutor(container, timeout=10)
         cmd = explore_command(cmd=[exe], executor=exec)
         path = out_dir / (cmd.as_filename + ".yml")
         # Rather than writing out the whole tree, which has redundant information, we instead take the top level command
         # which contains the entire tree, and serialize that
-        gen.save_to_file(cmd, path)
+        yml_generator.save_to_file(cmd, path)
 
         if wrapper_root:
             wrapper_from_command(
@@ -156,7 +575,7 @@ def aclimatise_exe(
     except Exception as e:
         handle_exception()
 
-    logger.info("Successfully written to YAML".format(exe))
+    logger.debug("Successfully written to YAML".format(exe))
 
 
 def calculate_metadata(
@@ -183,6 +602,26 @@ def calculate_metadata(
     )
 
 
+def makedirs(path: pathlib.Path):
+    """
+    Creates a directory and its parents if they don't already exist, skipping the mkdir entirely if this process has
+    already done so
+    """
+    if path not in _created_dirs:
+        path.mkdir(parents=True, exist_ok=True)
+        _created_dirs.add(path)
+
+
+def wrapper_generators() -> List[WrapperGenerator]:
+    """
+    Returns an instance of each WrapperGenerator, which are shared by every command this process converts
+    """
+    global _generators
+    if _generators is None:
+        _generators = [Gen() for Gen in WrapperGenerator.__subclasses__()]
+    return _generators
+
+
 def wrapper_from_command(
     cmd: Command,
     command_path: pathlib.Path,
@@ -205,12 +644,12 @@ def wrapper_from_command(
 
     logger.info("Outputting wrappers to {}".format(output_path))
 
-    output_path.mkdir(parents=True, exist_ok=True)
+    makedirs(output_path)
 
     try:
-        generators = [Gen() for Gen in WrapperGenerator.__subclasses__()]
+        generators = wrapper_generators()
         for cmd in cmd.command_tree():
-            logger.info("Converting {}".format(cmd.as_filename))
+            logger.debug("Converting {}".format(cmd.as_filename))
             if len(cmd.subcommands) > 0:
                 # Since we're dumping directly usable tool definitions, it doesn't make sense to dump the parent
                 # commands like "samtools" rather than "samtools index", so skip them
@@ -223,7 +662,7 @@ def wrapper_from_command(
             for gen in generators:
                 path = output_path / (cmd.as_filename + gen.suffix)
                 gen.save_to_file(cmd, path)
-                logger.info(
+                logger.debug(
                     "{} converted to {}".format(" ".join(cmd.command), gen.suffix)
                 )
     except Exception as e:
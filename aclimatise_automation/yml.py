@@ -1,3 +1,30 @@
 from ruamel.yaml import YAML
+from ruamel.yaml.constructor import RoundTripConstructor
+
+try:
+    from ruamel.yaml import CParser
+except ImportError:
+    CParser = None
 
 yaml = YAML()
+
+
+class CRoundTripConstructor(RoundTripConstructor):
+    """
+    The round-trip constructor, for use with libyaml's combined reader, scanner and parser. The C parser doesn't keep
+    comments, so there's nothing for the constructor to attach them to
+    """
+
+    comment_handling = None
+
+
+# Loads the same types as yaml, since aclimatise and BaseCampMeta register their classes with the round-trip
+# constructor, but parses with libyaml when it's available, which is much faster for the large Command files. It's only
+# used for loading, since the C parser doesn't preserve comments. ruamel only uses CParser if no Python Reader or
+# Scanner is set, and quietly falls back to the pure Python parser otherwise
+fast_yaml = YAML()
+if CParser is not None:
+    fast_yaml.Reader = None
+    fast_yaml.Scanner = None
+    fast_yaml.Parser = CParser
+    fast_yaml.Constructor = CRoundTripConstructor
@@ -8,10 +8,13 @@ setup(
         "click",
         "aclimatise>=3.0.1",
         "ruamel.yaml",
+        "ruamel.yaml.clib",
         "packaging",
         "tqdm",
         "requests",
+        "requests-cache>=1.0",
         "docker",
+        "orjson",
     ],
     extras_require={
         "dev": ["pytest", "pre-commit"],
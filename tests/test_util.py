@@ -0,0 +1,78 @@
+import os
+from pathlib import Path
+
+from aclimatise_automation.util import (
+    chunk_size,
+    find_yml,
+    image_priority,
+    load_durations,
+    longest_first,
+    package_name,
+    save_durations,
+)
+
+
+def test_find_yml_matches_rglob(tmp_path: Path):
+    (tmp_path / "bwa" / "0.7.17").mkdir(parents=True)
+    (tmp_path / "bwa" / "0.7.17" / "bwa.yml").touch()
+    (tmp_path / "bwa" / "0.7.17" / "bwa_mem.yml").touch()
+    (tmp_path / "bwa" / "0.7.17" / "bwa.cwl").touch()
+    (tmp_path / "samtools" / "1.9").mkdir(parents=True)
+    (tmp_path / "samtools" / "1.9" / "samtools.yml").touch()
+    (tmp_path / "top.yml").touch()
+
+    # Symlinked directories aren't descended into by either, but symlinked files are found by both
+    os.symlink(tmp_path / "samtools", tmp_path / "samtools_link")
+    os.symlink(tmp_path / "top.yml", tmp_path / "bwa" / "link.yml")
+
+    assert sorted(find_yml(str(tmp_path))) == sorted(
+        str(path) for path in tmp_path.rglob("*.yml")
+    )
+
+
+def test_durations_round_trip(tmp_path: Path):
+    path = tmp_path / "durations.json"
+    durations = {"bwa": 12.5, "samtools": 300.0}
+    save_durations(path, durations)
+    assert load_durations(path) == durations
+
+
+def test_load_durations_missing_file(tmp_path: Path):
+    assert load_durations(tmp_path / "durations.json") == {}
+
+
+def test_longest_first():
+    packages = ["bwa=0.7.17", "samtools=1.9", "bedtools=2.29.2", "blast=2.10.1"]
+    durations = {"samtools": 300.0, "bwa": 12.5, "fastqc": 50.0}
+    assert longest_first(packages, durations) == [
+        "samtools=1.9",
+        "bwa=0.7.17",
+        # Packages that haven't been run before come last, longest string first
+        "bedtools=2.29.2",
+        "blast=2.10.1",
+    ]
+
+
+def test_package_name():
+    assert package_name("bwa=0.7.17") == "bwa"
+    assert package_name("  bwa=0.7.17\n") == "bwa"
+    assert package_name("bwa") == "bwa"
+
+
+def test_chunk_size():
+    assert chunk_size(1000, 5) == 50
+    # Every chunk has at least one task
+    assert chunk_size(3, 5) == 1
+    assert chunk_size(0, 5) == 1
+
+
+def test_image_priority():
+    older_quay = {"updated": "2019-01-01T00:00:00Z", "registry_host": "quay.io/"}
+    newer_docker = {
+        "updated": "2020-01-01T00:00:00Z",
+        "registry_host": "depot.galaxyproject.org/",
+    }
+    newer_quay = {"updated": "2020-01-01T00:00:00Z", "registry_host": "quay.io/"}
+    assert sorted(
+        [older_quay, newer_quay, newer_docker], key=image_priority, reverse=True
+    ) == [newer_quay, newer_docker, older_quay]